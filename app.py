@@ -1,15 +1,49 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import yfinance as yf
-import matplotlib.pyplot as plt
-import math, os, glob, datetime as dt
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import altair as alt
+import os, glob, json, datetime as dt
+
+from snr_kernels import snr_quantiles, last_snr, suggest_array
+from cache import FileCache
 
 st.set_page_config(page_title="看股空間｜全市場 + 產業篩選（每日資料庫）", layout="wide")
 
 DATA_FUND = "data/fundamentals.parquet"
 DATA_SNR  = "data/snr_summary.parquet"
+DATA_SNR_SERIES = "data/snr_series.parquet"  # 每檔每日收盤（依 Ticker 排序），S/N/R 由 App 依視窗計算
+DATA_MANIFEST = "data/manifest.json"  # data_updater 每次更新寫入：資料日期與各檔路徑
+SNR_WINDOW = 120  # data_updater 預先計算時使用的視窗
+
+# UI 實際用到的欄位；讀 Parquet 時只解壓這些欄
+FUND_COLS = ["Ticker","shortName","sector","industry","trailingPE","priceToBook",
+             "returnOnEquity","grossMargins","operatingMargins","revenueGrowth","earningsGrowth","asOfDate"]
+SNR_COLS  = ["Ticker","LastDate","Close","S","N","R","asOfDate"]
+
+# yfinance 內部本來就共用同一個 session（keep-alive）；這裡只開啟暫時性錯誤的重試
+yf.config.network.retries = 3
+
+# L1：st.cache_data（行程內）；L2：FileCache（磁碟，重啟/冷啟動後仍有效）
+# 每次互動都會重跑整支腳本；FileCache 建立時會掃目錄清過期檔，所以每個行程只建一次
+@st.cache_resource
+def _fcache() -> FileCache:
+    return FileCache(".cache", ttl_days=1)
 
 # ---------- 資料庫讀取（Parquet 優先；失敗/為空則改讀最新 CSV） ----------
+def _read_manifest() -> dict:
+    try:
+        with open(DATA_MANIFEST, encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _read_parquet_cols(path: str, cols: list) -> pd.DataFrame:
+    d = ds.dataset(path, format="parquet")
+    return d.to_table(columns=[c for c in cols if c in d.schema.names]).to_pandas()
+
 @st.cache_data(ttl=60*30)
 def load_db():
     fund_df = None
@@ -18,13 +52,13 @@ def load_db():
     # 先讀 Parquet
     if os.path.exists(DATA_FUND):
         try:
-            fund_df = pd.read_parquet(DATA_FUND)
+            fund_df = _read_parquet_cols(DATA_FUND, FUND_COLS)
             used_files.append("fundamentals.parquet")
         except Exception as e:
             used_files.append(f"fundamentals.parquet 讀取失敗：{e}")
     if os.path.exists(DATA_SNR):
         try:
-            snr_df = pd.read_parquet(DATA_SNR)
+            snr_df = _read_parquet_cols(DATA_SNR, SNR_COLS)
             used_files.append("snr_summary.parquet")
         except Exception as e:
             used_files.append(f"snr_summary.parquet 讀取失敗：{e}")
@@ -59,15 +93,39 @@ def load_db():
                 return None
         return None
 
-    # 以 fundamentals 為主，沒有就看 snr_summary
-    data_date = pick_date(fund_df, "data/fundamentals_*.csv") or pick_date(snr_df, "data/snr_summary_*.csv")
+    # 先看 data_updater 寫的 manifest（一次 open）；沒有才以 fundamentals 為主、再看 snr_summary
+    data_date = (_read_manifest().get("date")
+                 or pick_date(fund_df, "data/fundamentals_*.csv") or pick_date(snr_df, "data/snr_summary_*.csv"))
+
+    # SNR 概況以 Ticker 為索引（每檔取最後一列），Top-N 迴圈直接查表
+    if snr_df is not None and "Ticker" in snr_df.columns:
+        snr_df = snr_df.drop_duplicates("Ticker", keep="last").set_index("Ticker", drop=False)
+
+    # sector/industry 轉 category：篩選時只需對少量類別跑 regex
+    if fund_df is not None:
+        for c in ("sector", "industry"):
+            if c in fund_df.columns:
+                fund_df[c] = fund_df[c].astype("category")
+        fund_df["_name_lc"] = fund_df["shortName"].fillna("").astype(str).str.lower()
     return fund_df, snr_df, used_files, data_date
 
 # ---------- SNR 與工具 ----------
 @st.cache_data(ttl=60*30)
-def fetch_history(ticker: str, days: int = 365) -> pd.DataFrame:
-    df = yf.download(ticker, period=f"{int(days)}d", interval="1d",
-                     auto_adjust=True, progress=False, threads=False, group_by="ticker")
+def load_snr_series(tickers: tuple) -> dict:
+    """讀 data_updater 存的每日收盤序列（日期/Close）；只取指定 Ticker，缺的回傳空表。"""
+    out = {t: pd.DataFrame() for t in tickers}
+    if not tickers or not os.path.exists(DATA_SNR_SERIES):
+        return out
+    try:
+        df = pq.read_table(DATA_SNR_SERIES, filters=[("Ticker", "in", list(tickers))]).to_pandas()
+    except Exception:
+        return out
+    df["Ticker"] = df["Ticker"].astype(str)
+    for t, g in df.groupby("Ticker", sort=False):
+        out[t] = g.drop(columns=["Ticker"]).sort_values("日期").reset_index(drop=True)
+    return out
+
+def _tidy_history(df: pd.DataFrame, ticker: str) -> pd.DataFrame:
     if df is None or df.empty:
         return pd.DataFrame()
     if isinstance(df.columns, pd.MultiIndex):
@@ -77,53 +135,124 @@ def fetch_history(ticker: str, days: int = 365) -> pd.DataFrame:
         except Exception:
             df.columns = [c[-1] if isinstance(c, tuple) else c for c in df.columns]
     df.index = pd.to_datetime(df.index)
-    df = df.rename_axis("日期").reset_index()
-    return df.dropna(subset=["Close"])
-
-def compute_snr(df: pd.DataFrame, window: int = 120):
-    if df.empty or "Close" not in df.columns:
-        return df.assign(支撐=pd.NA, 中位=pd.NA, 壓力=pd.NA)
-    roll = df["Close"].rolling(window, min_periods=max(20, window//4))
-    out = df.copy()
-    out["支撐"] = roll.quantile(0.20)
-    out["中位"] = roll.quantile(0.50)
-    out["壓力"] = roll.quantile(0.80)
+    return df.rename_axis("日期").reset_index().dropna(subset=["Close"])
+
+def trading_day() -> str:
+    # 快取 key 的日期（台北時間）：同一天所有使用者共用同一份下載，跨日自動換 key
+    return dt.datetime.now(dt.timezone(dt.timedelta(hours=8))).date().isoformat()
+
+def history_days(win: int) -> int:
+    # 視窗是交易日，下載用日曆日（約 7/5 倍）再多留一個月緩衝；至少 150 天
+    return max(150, win * 7 // 5 + 30)
+
+@st.cache_data(ttl=60*30, show_spinner=False)
+def fetch_history(ticker: str, days: int = 150, day: str = "") -> pd.DataFrame:
+    key = FileCache.key(ticker, days, day)
+    cached = _fcache().get_frame(key)
+    if cached is not None:
+        return cached
+    df = yf.download(ticker, period=f"{int(days)}d", interval="1d",
+                     auto_adjust=True, progress=False, group_by="ticker")
+    df = _tidy_history(df, ticker)
+    if not df.empty:
+        _fcache().put_frame(key, df)
+    return df
+
+@st.cache_data(ttl=60*30, show_spinner=False)
+def fetch_history_many(tickers: tuple, days: int = 150, day: str = "") -> dict:
+    """一次 yf.download 抓多檔（key 用排序後的 tuple），回傳 {ticker: DataFrame}。"""
+    out, missing = {}, []
+    for t in tickers:
+        cached = _fcache().get_frame(FileCache.key(t, days, day))
+        if cached is not None: out[t] = cached
+        else: missing.append(t)
+    if not missing:
+        return out
+    raw = yf.download(" ".join(missing), period=f"{int(days)}d", interval="1d",
+                      auto_adjust=True, progress=False, threads=True, group_by="ticker")
+    have = set(raw.columns.get_level_values(0)) if raw is not None and isinstance(raw.columns, pd.MultiIndex) else set()
+    for t in missing:
+        df = _tidy_history(raw[t], t) if t in have else pd.DataFrame()
+        if not df.empty:
+            _fcache().put_frame(FileCache.key(t, days, day), df)
+        out[t] = df
     return out
 
+def compute_snr(dates, close, window: int = 120) -> dict:
+    """只吃日期與收盤兩個陣列，回傳畫圖需要的 5 欄（不複製整張 OHLCV）。"""
+    S, N, R = snr_quantiles(close, window, max(20, window//4))
+    return {"日期": dates, "Close": close, "支撐": S, "中位": N, "壓力": R}
+
+# 圖在瀏覽器端以 Vega-Lite 繪製，伺服器只送資料（不再產生 PNG）
+SNR_LABELS = {"Close": "收盤", "支撐": "支撐(20%)", "中位": "中位(50%)", "壓力": "壓力(80%)"}
+
+@st.cache_data(ttl=60*30)
+def snr_long(snr: pd.DataFrame) -> pd.DataFrame:
+    long = snr.melt("日期", list(SNR_LABELS), var_name="系列", value_name="價格")
+    long["系列"] = long["系列"].map(SNR_LABELS)
+    return long
+
+def draw_snr(snr: pd.DataFrame, title: str):
+    chart = alt.Chart(snr_long(snr), title=title).mark_line().encode(
+        x=alt.X("日期:T", title="日期"),
+        y=alt.Y("價格:Q", title="價格", scale=alt.Scale(zero=False)),
+        color=alt.Color("系列:N", sort=list(SNR_LABELS.values()), title=None),
+        strokeDash=alt.condition(alt.datum["系列"] == "收盤", alt.value([1, 0]), alt.value([5, 3])),
+    )
+    st.altair_chart(chart, use_container_width=True)
+
 def suggest(last_close, S, R, near=0.03):
-    import pandas as pd
-    if any(pd.isna(x) for x in (last_close, S, R)):
-        return "資料不足"
-    dS = (last_close - S) / S if S else math.inf
-    dR = (R - last_close) / R if R else math.inf
-    if dS <= near: return "接近支撐：偏多、可分批佈局"
-    if dR <= near: return "接近壓力：保守、等待回檔"
-    if last_close < (S + R) / 2: return "區間下半：偏多但勿追高"
-    return "區間上半：觀望或逢高減碼"
+    return str(suggest_array([last_close], [S], [R], near)[0])
 
-def score_frame(df: pd.DataFrame):
-    def rank(s: pd.Series, asc=True):
-        r = s.rank(method="average", ascending=asc, na_option="keep")
-        if r.isna().all(): return pd.Series([float("nan")] * len(s), index=s.index)
+# 評分欄位：估值(越小越好) / 品質、成長(越大越好)；越大越好的欄位取負號後一律升冪排名
+SCORE_COLS = ["trailingPE","priceToBook",
+              "returnOnEquity","grossMargins","operatingMargins",
+              "revenueGrowth","earningsGrowth"]
+SCORE_SIGN = np.array([1, 1, -1, -1, -1, -1, -1], dtype=np.float32)
+SCORE_GROUPS = (slice(0, 2), slice(2, 5), slice(5, 7))
+SCORE_WEIGHTS = np.array([0.40, 0.35, 0.25], dtype=np.float32)
+
+def _norm_ranks(X: np.ndarray) -> np.ndarray:
+    # 逐欄平均名次（同 rank(method="average")），再以 (rmax - r) / (rmax - rmin) 正規化
+    out = np.full(X.shape, np.nan, dtype=np.float32)
+    for j in range(X.shape[1]):
+        col = X[:, j]
+        ok = ~np.isnan(col)
+        if not ok.any(): continue
+        v = col[ok]
+        s = np.sort(v)
+        r = (np.searchsorted(s, v, "left") + np.searchsorted(s, v, "right") + 1) / 2
         rmin, rmax = r.min(), r.max()
-        if rmax == rmin: return pd.Series([0.5] * len(s), index=s.index)
-        return (rmax - r) / (rmax - rmin)
-    val = pd.DataFrame(index=df.index)
-    val["PE"] = rank(df["trailingPE"], asc=True)
-    val["PB"] = rank(df["priceToBook"], asc=True)
-    val["估值分數"] = val[["PE","PB"]].mean(axis=1, skipna=True)
-    qua = pd.DataFrame(index=df.index)
-    qua["ROE"] = rank(df["returnOnEquity"], asc=False)
-    qua["毛利"] = rank(df["grossMargins"], asc=False)
-    qua["營益"] = rank(df["operatingMargins"], asc=False)
-    qua["品質分數"] = qua[["ROE","毛利","營益"]].mean(axis=1, skipna=True)
-    gro = pd.DataFrame(index=df.index)
-    gro["營收"] = rank(df["revenueGrowth"], asc=False)
-    gro["獲利"] = rank(df["earningsGrowth"], asc=False)
-    gro["成長分數"] = gro[["營收","獲利"]].mean(axis=1, skipna=True)
-    score = pd.concat([val["估值分數"], qua["品質分數"], gro["成長分數"]], axis=1)
-    score["total_score"] = 0.40*score["估值分數"] + 0.35*score["品質分數"] + 0.25*score["成長分數"]
-    return pd.concat([df, score], axis=1)
+        if rmax == rmin: out[:, j] = 0.5
+        else: out[ok, j] = (rmax - r) / (rmax - rmin)
+    return out
+
+def _row_nanmean(A: np.ndarray) -> np.ndarray:
+    cnt = (~np.isnan(A)).sum(axis=1)
+    return np.where(cnt > 0, np.nansum(A, axis=1) / np.maximum(cnt, 1), np.nan)
+
+def score_frame(df: pd.DataFrame):
+    # 資料庫本身存 float32，評分全程維持 float32
+    X = df[SCORE_COLS].to_numpy(dtype=np.float32) * SCORE_SIGN
+    norm = _norm_ranks(X)
+    sub = np.column_stack([_row_nanmean(norm[:, g]) for g in SCORE_GROUPS])
+    return df.assign(估值分數=sub[:, 0], 品質分數=sub[:, 1], 成長分數=sub[:, 2],
+                     total_score=sub @ SCORE_WEIGHTS)
+
+@st.cache_data(ttl=60*30)
+def category_options(_fund_df: pd.DataFrame, data_date):
+    # 以資料日期為 key（_fund_df 不做雜湊）；category 的類別本身已去重、不含 NaN
+    return (sorted(str(x) for x in _fund_df["sector"].cat.categories),
+            sorted(str(x) for x in _fund_df["industry"].cat.categories))
+
+def _sector_mask(df: pd.DataFrame, text: str) -> pd.Series:
+    # 不分大小寫的子字串比對（不走 regex）：sector/industry 只比對類別字串再 isin；
+    # shortName 幾乎不重複，用 load_db 預先轉好的小寫欄位逐列比對
+    t = text.lower()
+    good_sec = [c for c in df["sector"].cat.categories if t in str(c).lower()]
+    good_ind = [c for c in df["industry"].cat.categories if t in str(c).lower()]
+    return (df["sector"].isin(good_sec) | df["industry"].isin(good_ind)
+            | df["_name_lc"].str.contains(t, regex=False))
 
 # ---------- UI ----------
 st.title("看股空間｜全市場 + 產業篩選（每日資料庫）")
@@ -145,27 +274,33 @@ with colL:
         st.warning("資料庫不存在或為空。請先在 GitHub Actions 手動執行一次更新，或稍後再試。")
     else:
         # 產業類別清單（可能混中英）
-        sectors    = sorted(set(str(x) for x in fund_df["sector"].dropna().unique()))
-        industries = sorted(set(str(x) for x in fund_df["industry"].dropna().unique()))
-        st.subheader("篩選條件")
-        pick = st.selectbox("選擇產業（不選代表全部）", ["全部"] + sectors + industries, index=0)
-        kw   = st.text_input("或輸入關鍵字（例如：半導體 / Semiconductor）", "")
-        topn = st.number_input("Top-N（精選數量）", min_value=1, max_value=100, value=5, step=1)
-        win  = st.slider("SNR 視窗（天）", min_value=60, max_value=240, value=120, step=10)
-        near = st.slider("接近支撐/壓力判定（%）", min_value=1, max_value=10, value=3, step=1) / 100.0
-
-        df = fund_df.copy()
-        if pick != "全部":
-            mask = df[["sector","industry","shortName"]].astype(str).apply(lambda s: s.str.contains(pick, case=False, na=False))
-            df = df[mask.any(axis=1)]
-        if kw.strip():
-            mask = df[["sector","industry","shortName"]].astype(str).apply(lambda s: s.str.contains(kw, case=False, na=False))
-            df = df[mask.any(axis=1)]
-
-        if df.empty:
+        sectors, industries = category_options(fund_df, data_date)
+        # 條件放在表單內：拖動滑桿不會觸發重跑，按「套用」才重新篩選/評分
+        with st.form("filters"):
+            st.subheader("篩選條件")
+            pick = st.selectbox("選擇產業（不選代表全部）", ["全部"] + sectors + industries, index=0)
+            kw   = st.text_input("或輸入關鍵字（例如：半導體 / Semiconductor）", "")
+            topn = st.number_input("Top-N（精選數量）", min_value=1, max_value=100, value=5, step=1)
+            win  = st.slider("SNR 視窗（天）", min_value=60, max_value=240, value=120, step=10)
+            near = st.slider("接近支撐/壓力判定（%）", min_value=1, max_value=10, value=3, step=1) / 100.0
+            submitted = st.form_submit_button("套用")
+
+        # 評分結果存在 session_state；其他元件（例如右側查詢）觸發重跑時直接沿用
+        if submitted or st.session_state.get("scored_date", "") != data_date:
+            # 先用布林遮罩篩選，再只對留下的列評分（不先複製整張表）
+            mask = pd.Series(True, index=fund_df.index)
+            if pick != "全部":
+                mask &= _sector_mask(fund_df, pick)
+            if kw.strip():
+                mask &= _sector_mask(fund_df, kw.strip())
+            df = fund_df.loc[mask]
+            st.session_state["scored"] = None if df.empty else score_frame(df).sort_values("total_score", ascending=False)
+            st.session_state["scored_date"] = data_date
+        scored = st.session_state["scored"]
+
+        if scored is None:
             st.warning("沒有符合條件的股票。請更換產業或關鍵字。")
         else:
-            scored = score_frame(df).sort_values("total_score", ascending=False)
             show_cols = ["Ticker","shortName","sector","industry","trailingPE","priceToBook",
                          "returnOnEquity","grossMargins","operatingMargins","revenueGrowth","earningsGrowth",
                          "total_score"]
@@ -175,51 +310,57 @@ with colL:
             picks = scored.head(topn)
 
             st.markdown("---")
-            st.markdown("### Top-N 的 SNR 圖與建議")
-            for t in picks["Ticker"].tolist():
+            st.markdown("### Top-N 的 SNR 建議與圖")
+            tickers = picks["Ticker"].tolist()
+            # 建議：視窗與資料庫相同時直接用 snr_df 的 Close/S/R 判斷，不讀序列也不下載
+            quick = {}
+            have = [t for t in tickers if snr_df is not None and t in snr_df.index]
+            if win == SNR_WINDOW and have:
+                rows = snr_df.loc[have]
+                quick = dict(zip(have, suggest_array(rows["Close"], rows["S"], rows["R"], near)))
+            # 圖：打開開關才讀序列／下載（expander 內的程式不論收合都會執行，所以用 toggle）
+            show_chart = st.toggle("顯示 SNR 圖", value=False)
+            need = [t for t in tickers if show_chart or t not in quick]
+            stored = load_snr_series(tuple(sorted(need)))
+            hists = fetch_history_many(tuple(sorted(t for t in need if stored[t].empty)),
+                                       history_days(win), trading_day())
+            for t in tickers:
                 # 若資料庫有 SNR 概況，先顯示
-                if snr_df is not None and not snr_df.empty:
-                    row = snr_df[snr_df["Ticker"] == t].tail(1)
-                    if not row.empty:
-                        st.markdown(
-                            f"**{t}**｜{row['LastDate'].iloc[0]}｜現價：{round(float(row['Close'].iloc[0]),2)}"
-                        )
-                        # 依近距再給建議（以現算為準更準確）
-                # 畫 SNR 圖（即時算 Top-N，不會太慢）
-                hist = fetch_history(t, 365)
-                if hist.empty:
+                if t in have:
+                    row = snr_df.loc[t]
+                    st.markdown(f"**{t}**｜{row['LastDate']}｜現價：{round(float(row['Close']),2)}")
+                if t in quick and not show_chart:
+                    st.write(f"建議：{quick[t]}")
+                    continue
+                # 資料庫有序列就用序列；沒有才用下載的歷史價
+                src = stored[t] if not stored[t].empty else hists.get(t, pd.DataFrame())
+                if src.empty:
                     st.warning(f"{t} 無法取得歷史資料")
                     continue
-                snr = compute_snr(hist, win)
-                last = snr.dropna(subset=["Close"]).iloc[-1]
-                advice = suggest(last["Close"], last.get("支撐"), last.get("壓力"), near)
+                if t in quick:
+                    advice = quick[t]
+                else:
+                    # 只要建議時不必算整段序列：最後一個視窗的分位數就夠
+                    close = src["Close"].to_numpy()
+                    S, _, R = last_snr(close, win, max(20, win//4))
+                    advice = suggest(close[-1], S, R, near)
                 st.write(f"建議：{advice}")
-                fig, ax = plt.subplots(figsize=(8, 4))
-                ax.plot(snr["日期"], snr["Close"], label="收盤")
-                ax.plot(snr["日期"], snr["支撐"], linestyle="--", label="支撐(20%)")
-                ax.plot(snr["日期"], snr["中位"], linestyle="--", label="中位(50%)")
-                ax.plot(snr["日期"], snr["壓力"], linestyle="--", label="壓力(80%)")
-                ax.set_title(f"{t} 的 SNR"); ax.set_xlabel("日期"); ax.set_ylabel("價格"); ax.legend()
-                st.pyplot(fig)
+                if show_chart:
+                    snr = pd.DataFrame(compute_snr(src["日期"].to_numpy(), src["Close"].to_numpy(), win))
+                    draw_snr(snr, f"{t} 的 SNR")
 
 # -------- 右：單檔查詢 --------
 with colR:
     st.subheader("單檔查詢（即時）")
     q = st.text_input("輸入股票代碼（台股 .TW/.TWO，例如 2330.TW）", "2330.TW")
     if st.button("查詢"):
-        hist = fetch_history(q, 365)
+        hist = fetch_history(q, history_days(120), trading_day())
         if hist.empty:
             st.error("抓不到資料，請檢查代碼或稍後再試。")
         else:
-            snr = compute_snr(hist, 120)
+            snr = pd.DataFrame(compute_snr(hist["日期"].to_numpy(), hist["Close"].to_numpy(), 120))
             last = snr.dropna(subset=["Close"]).iloc[-1]
             st.markdown(f"**{q}**｜{last['日期'].date()}｜現價：{round(float(last['Close']),2)}")
-            fig, ax = plt.subplots(figsize=(8, 4))
-            ax.plot(snr["日期"], snr["Close"], label="收盤")
-            ax.plot(snr["日期"], snr["支撐"], linestyle="--", label="支撐(20%)")
-            ax.plot(snr["日期"], snr["中位"], linestyle="--", label="中位(50%)")
-            ax.plot(snr["日期"], snr["壓力"], linestyle="--", label="壓力(80%)")
-            ax.set_title(f"{q} 的 SNR"); ax.set_xlabel("日期"); ax.set_ylabel("價格"); ax.legend()
-            st.pyplot(fig)
+            draw_snr(snr, f"{q} 的 SNR")
 
 st.caption("免責聲明：本工具僅供研究與教育用途，非投資建議。")
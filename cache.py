@@ -0,0 +1,69 @@
+# cache.py
+# 磁碟快取（L2）：DataFrame 存 Parquet、dict 存 JSON，旁邊放一份 meta（抓取時間 / yfinance 版本）。
+# 過期（超過 TTL）或 yfinance 版本變動即視為失效；讀寫失敗一律當作沒有快取，不影響主流程。
+
+import hashlib, json, time
+from pathlib import Path
+import pandas as pd
+import yfinance as yf
+
+class FileCache:
+    def __init__(self, path: str = ".cache", ttl_days: float = 1):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl_days * 86400
+        self._prune()
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.md5("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+    def _meta(self, key: str) -> Path:
+        return self.path / f"{key}.meta.json"
+
+    def _fresh(self, key: str) -> bool:
+        try:
+            meta = json.loads(self._meta(key).read_text())
+        except Exception:
+            return False
+        return (time.time() - meta.get("fetched_at", 0) < self.ttl
+                and meta.get("yf_version") == yf.__version__)
+
+    def _prune(self):
+        # 啟動時清掉過期 / 版本不符 / 缺 meta 的項目，避免目錄無限長大（只看這一層，不碰子目錄）
+        try:
+            for p in self.path.iterdir():
+                if not p.is_file(): continue
+                key = p.name.split(".", 1)[0]
+                if not self._fresh(key): p.unlink(missing_ok=True)
+        except Exception:
+            pass
+
+    def _stamp(self, key: str):
+        self._meta(key).write_text(json.dumps({"fetched_at": time.time(), "yf_version": yf.__version__}))
+
+    def get_frame(self, key: str):
+        p = self.path / f"{key}.parquet"
+        if not p.exists() or not self._fresh(key): return None
+        try: return pd.read_parquet(p)
+        except Exception: return None
+
+    def put_frame(self, key: str, df: pd.DataFrame):
+        try:
+            df.to_parquet(self.path / f"{key}.parquet", index=False)
+            self._stamp(key)
+        except Exception:
+            pass
+
+    def get_json(self, key: str):
+        p = self.path / f"{key}.json"
+        if not p.exists() or not self._fresh(key): return None
+        try: return json.loads(p.read_text(encoding="utf-8"))
+        except Exception: return None
+
+    def put_json(self, key: str, obj):
+        try:
+            (self.path / f"{key}.json").write_text(json.dumps(obj, ensure_ascii=False, default=str), encoding="utf-8")
+            self._stamp(key)
+        except Exception:
+            pass
@@ -1,11 +1,21 @@
 # data_updater.py
+import numpy as np
 import pandas as pd
 import yfinance as yf
-import requests, time, os, glob
+from yahooquery import Ticker as YQTicker
+import time, os, re, json, glob, shutil, threading
 from pathlib import Path
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.csv as pacsv
+import lxml.html
 
+from snr_kernels import snr_quantiles, snr_quantiles_2d, suggest_array
+from cache import FileCache
 from fetch_industry_and_sectors import (
+    SESSION,
     update_industry_map,
     attach_industry_to_fundamentals,
     compute_sector_performance,
@@ -15,58 +25,114 @@ from fetch_industry_and_sectors import (
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-HEADERS = {
-    "User-Agent": "Mozilla/5.0",
-    "Accept-Language": "zh-TW,zh;q=0.9,en;q=0.8",
-}
+# yfinance 內部本來就共用同一個 session（keep-alive）；這裡只開啟暫時性錯誤的重試
+yf.config.network.retries = 3
 
 def log(msg): print(f"[{dt.datetime.now().strftime('%H:%M:%S')}] {msg}")
 
+def write_csv(df: pd.DataFrame, path: Path):
+    """pyarrow 在 C 端整批寫 CSV；前面補 UTF-8 BOM（Excel 開中文不亂碼），寫完暫存檔再改名。"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(b"\xef\xbb\xbf")
+        pacsv.write_csv(pa.Table.from_pandas(df, preserve_index=False), f)
+    os.replace(tmp, path)
+
 # ---------- 代碼清單（上市/上櫃） ----------
+TICKERS_CACHE = DATA_DIR / "tickers_latest.parquet"
+TICKERS_TTL = 7 * 86400  # 上市櫃清單約每月才變動，一週重抓一次即可
+CODE_NAME_RE = re.compile(r"^(\d{4,6})\s+(.+)$")  # 「2330　台積電」→ 代號 / 名稱
+
+def _parse_isin_table(html: str) -> pd.DataFrame:
+    # 只取需要的那張表：直接走 lxml xpath，不讓 read_html 把整頁每張表都建成 DataFrame
+    rows = [[td.text_content().strip() for td in tr.xpath("./td")]
+            for tr in lxml.html.fromstring(html).xpath("//tr[td]")]
+    head = next((i for i, r in enumerate(rows) if any("代號" in c for c in r)), None)
+    if head is None:
+        return pd.DataFrame()
+    cols = rows[head]
+    # 「股票」「上市認購(售)權證」等分類列只有一格，欄數對不上就略過
+    return pd.DataFrame([r for r in rows[head + 1:] if len(r) == len(cols)], columns=cols)
+
 def fetch_tw_tickers(retries=3, sleep_sec=2) -> pd.DataFrame:
+    # 抓取時間記在檔內：CI 每次 checkout 都會重設檔案 mtime，不能拿來判斷 TTL
+    cached = None
+    if TICKERS_CACHE.exists():
+        try:
+            cached = pd.read_parquet(TICKERS_CACHE)
+            if time.time() - float(cached["fetchedAt"].iloc[0]) < TICKERS_TTL:
+                log(f"INFO 台股代碼數：{len(cached)}（沿用 {TICKERS_CACHE.name}）")
+                return cached.drop(columns=["fetchedAt"])
+        except Exception as e:
+            cached = None
+            log(f"WARN 代碼快取讀取失敗，改為重新抓取：{e}")
     urls = [
         "https://isin.twse.com.tw/isin/C_public.jsp?strMode=2",  # 上市
         "https://isin.twse.com.tw/isin/C_public.jsp?strMode=4",  # 上櫃
     ]
-    frames = []
+    frames, all_ok = [], True
     for u in urls:
         ok = False
         for _ in range(retries):
             try:
-                html = requests.get(u, headers=HEADERS, timeout=30).text
-                # lxml -> bs4/html5lib
-                try:
-                    tables = pd.read_html(html)
-                except Exception:
-                    tables = pd.read_html(html, flavor="bs4")
-                if tables:
-                    frames.append(tables[0]); ok = True; break
+                html = SESSION.get(u, timeout=30).text
+                table = _parse_isin_table(html)
+                if not table.empty:
+                    frames.append(table); ok = True; break
             except Exception as e:
                 log(f"WARN 代碼來源失敗一次：{u} ({e})"); time.sleep(sleep_sec)
-        if not ok: log(f"WARN 放棄該來源：{u}")
+        if not ok:
+            log(f"WARN 放棄該來源：{u}"); all_ok = False
+    # 任一來源失敗時，只拿到上市或上櫃其中一半：有舊清單（即使過期）就先沿用，不寫快取
+    if not all_ok and cached is not None:
+        log(f"WARN 代碼來源不完整，沿用上一版 {TICKERS_CACHE.name}：{len(cached)}")
+        return cached.drop(columns=["fetchedAt"])
     if not frames:
         return pd.DataFrame(columns=["code","name","market","yahoo"])
     df = pd.concat(frames, ignore_index=True)
-    df.columns = df.iloc[0].tolist()
-    df = df.iloc[1:].reset_index(drop=True)
     code_name_col = next((c for c in df.columns if "代號" in str(c)), None)
     market_col    = next((c for c in df.columns if "市場別" in str(c)), None)
     if not code_name_col or not market_col:
         log("ERROR 找不到必要欄位（代號/市場別）")
         return pd.DataFrame(columns=["code","name","market","yahoo"])
-    parsed = df[code_name_col].astype(str).str.extract(r"^(\d{4,6})\s+(.+)$")
+    parsed = df[code_name_col].astype(str).str.extract(CODE_NAME_RE)
     parsed.columns = ["code","name"]
     out = pd.concat([parsed, df[market_col].rename("market")], axis=1).dropna(subset=["code"])
-    out = out[out["code"].str.match(r"^\d{4}$")]
+    # 只留 4 碼純數字的普通股：長度 + isdigit 即可，不必再跑 regex
+    out = out[out["code"].str.len().eq(4) & out["code"].str.isdigit()]
     out["yahoo"] = out["code"] + out["market"].apply(lambda m: ".TWO" if "上櫃" in str(m) else ".TW")
     out = out[["code","name","market","yahoo"]].drop_duplicates()
     today = dt.date.today().isoformat()
-    (DATA_DIR / f"tickers_{today}.csv").write_text(out.to_csv(index=False, encoding="utf-8-sig"))
+    write_csv(out, DATA_DIR / f"tickers_{today}.csv")
+    if all_ok:
+        out.reset_index(drop=True).assign(fetchedAt=time.time()).to_parquet(TICKERS_CACHE, index=False)
     log(f"INFO 台股代碼數：{len(out)}")
     return out
 
 # ---------- yfinance ----------
+class RateLimiter:
+    """多執行緒共用的節流：任兩次 wait() 之間至少相隔 1/calls_per_sec 秒。"""
+    def __init__(self, calls_per_sec: float):
+        self.gap = 1.0 / calls_per_sec
+        self.next = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next)
+            self.next = at + self.gap
+        if at > now: time.sleep(at - now)
+
+# 基本面當日快取：僅供本機同一天重跑時省下整段抓取（.cache 不進版控，CI 每次都是乾淨 checkout，用不到）
+FUND_CACHE = FileCache(".cache/fund", ttl_days=1)
+
+# 逐檔補抓走執行緒池，統一限速避免被 Yahoo 擋
+YF_LIMIT = RateLimiter(calls_per_sec=20)
+
 def pull_fundamentals(ticker: str) -> dict:
+    YF_LIMIT.wait()
+    # 不另外傳 session：yfinance 的 YfData 是 singleton，所有執行緒本來就共用同一個 keep-alive session
     t = yf.Ticker(ticker)
     info, fast = {}, {}
     try: info = t.info or {}
@@ -91,13 +157,73 @@ def pull_fundamentals(ticker: str) -> dict:
         "lastPrice": fast.get("last_price") or info.get("currentPrice"),
     }
 
-def fetch_history_upto(ticker: str, end_date: dt.date, lookback_days: int = 420) -> pd.DataFrame:
-    end_plus = end_date + dt.timedelta(days=1)  # yfinance end 不含當日，+1
-    start = end_plus - dt.timedelta(days=lookback_days)
-    df = yf.download(
-        ticker, start=start.strftime("%Y-%m-%d"), end=end_plus.strftime("%Y-%m-%d"),
-        interval="1d", auto_adjust=True, progress=False, threads=False, group_by="ticker"
-    )
+YQ_MODULES = "price summaryProfile summaryDetail defaultKeyStatistics financialData"
+
+def _num(v):
+    # quoteSummary 缺值時回 {}（yahooquery 原樣保留），只留真正的數字
+    return v if isinstance(v, (int, float)) and not isinstance(v, bool) else None
+
+def _str(v):
+    return v if isinstance(v, str) else None
+
+def _yq_row(ticker: str, m: dict) -> dict:
+    price, prof = m.get("price") or {}, m.get("summaryProfile") or {}
+    det, stats, fin = m.get("summaryDetail") or {}, m.get("defaultKeyStatistics") or {}, m.get("financialData") or {}
+    return {
+        "Ticker": ticker,
+        "shortName": _str(price.get("shortName")),
+        "sector": _str(prof.get("sector")),
+        "industry": _str(prof.get("industry")),
+        "marketCap": _num(price.get("marketCap")) or _num(det.get("marketCap")),
+        "currency": _str(price.get("currency")) or _str(det.get("currency")),
+        "trailingPE": _num(det.get("trailingPE")),
+        "forwardPE": _num(det.get("forwardPE")) or _num(stats.get("forwardPE")),
+        "priceToBook": _num(stats.get("priceToBook")),
+        "returnOnEquity": _num(fin.get("returnOnEquity")),
+        "grossMargins": _num(fin.get("grossMargins")),
+        "operatingMargins": _num(fin.get("operatingMargins")),
+        "revenueGrowth": _num(fin.get("revenueGrowth")),
+        "earningsGrowth": _num(fin.get("earningsGrowth")),
+        "lastPrice": _num(price.get("regularMarketPrice")) or _num(fin.get("currentPrice")),
+    }
+
+def pull_fundamentals_batch(tickers: list, chunk: int = 100) -> pd.DataFrame:
+    """
+    yahooquery 一次送一批代碼（共用 session 與 crumb），欄位對應到 pull_fundamentals 的格式。
+    某檔拿不到（回傳錯誤字串或整批失敗）時，才退回逐檔 pull_fundamentals。
+    """
+    # 當天已抓過的（例如同一天重跑）直接讀 .cache/fund，不連網
+    today = dt.date.today().isoformat()
+    rows = {t: r for t in tickers if (r := FUND_CACHE.get_json(FileCache.key(t, today))) is not None}
+    todo, yq = [t for t in tickers if t not in rows], None
+    if rows: log(f"INFO 基本面沿用當日快取：{len(rows)}")
+    for i in range(0, len(todo), chunk):
+        part = todo[i:i+chunk]
+        try:
+            # 同一個 Ticker 物件換 symbols：所有批次共用同一個 session / crumb
+            # asynchronous：批內 quoteSummary 以 16 條連線並行送出（預設 8）
+            if yq is None: yq = YQTicker(part, asynchronous=True, max_workers=16)
+            else: yq.symbols = part
+            blob = yq.get_modules(YQ_MODULES)
+        except Exception as e:
+            log(f"WARN yahooquery 批次失敗：{e}"); blob = {}
+        if not isinstance(blob, dict): blob = {}
+        for t in part:
+            if isinstance(blob.get(t), dict):
+                rows[t] = _yq_row(t, blob[t])
+    missing = [t for t in todo if t not in rows]
+    if missing:
+        log(f"INFO 改用 yfinance 逐檔補抓：{len(missing)}")
+        with ThreadPoolExecutor(max_workers=16) as ex:
+            rows.update(zip(missing, ex.map(pull_fundamentals, missing)))
+    for t in todo:
+        # 全空的列（抓取失敗）不寫快取，下次重跑還會再試
+        if rows[t].get("shortName") or rows[t].get("marketCap"):
+            FUND_CACHE.put_json(FileCache.key(t, today), rows[t])
+    return pd.DataFrame([rows[t] for t in tickers])
+
+def _tidy_history(df: pd.DataFrame, ticker: str) -> pd.DataFrame:
+    # yfinance 的 MultiIndex 欄位攤平成 Date/Open/High/Low/Close/Volume
     if df is None or df.empty: return pd.DataFrame()
     if isinstance(df.columns, pd.MultiIndex):
         try:
@@ -109,33 +235,217 @@ def fetch_history_upto(ticker: str, end_date: dt.date, lookback_days: int = 420)
     df = df.rename_axis("Date").reset_index()
     return df.dropna(subset=["Close"])
 
+def fetch_history_upto(ticker: str, end_date: dt.date, lookback_days: int = 420) -> pd.DataFrame:
+    end_plus = end_date + dt.timedelta(days=1)  # yfinance end 不含當日，+1
+    start = end_plus - dt.timedelta(days=lookback_days)
+    df = yf.download(
+        ticker, start=start.strftime("%Y-%m-%d"), end=end_plus.strftime("%Y-%m-%d"),
+        interval="1d", auto_adjust=True, progress=False, threads=False, group_by="ticker"
+    )
+    return _tidy_history(df, ticker)
+
+def fetch_history(ticker: str, days: int = 400) -> pd.DataFrame:
+    return fetch_history_upto(ticker, dt.date.today(), days)
+
+HIST_CACHE = DATA_DIR / "hist_cache"  # 每檔一個 parquet；不進版控，CI 以 actions/cache 跨次沿用
+
+def _download_batch(tickers: list, days: int, chunk: int = 20):
+    """
+    每批 chunk 檔用一次 yf.download（批內由 yfinance 自己開執行緒），逐檔 yield (ticker, hist)。
+    批與批之間不並行：yf.download 的結果暫存在模組層級的共用 dict，同時呼叫會互相覆蓋。
+    批次裡沒拿到的代碼，再用單檔 fetch_history_upto 補抓一次。
+    """
+    today = dt.date.today()
+    end_plus = today + dt.timedelta(days=1)
+    start = end_plus - dt.timedelta(days=days)
+    for i in range(0, len(tickers), chunk):
+        part = tickers[i:i+chunk]
+        try:
+            raw = yf.download(
+                part, start=start.strftime("%Y-%m-%d"), end=end_plus.strftime("%Y-%m-%d"),
+                interval="1d", auto_adjust=True, progress=False, threads=True, group_by="ticker"
+            )
+        except Exception as e:
+            log(f"WARN 批次下載失敗，改逐檔：{e}"); raw = None
+        have = set(raw.columns.get_level_values(0)) if raw is not None and isinstance(raw.columns, pd.MultiIndex) else set()
+        for t in part:
+            hist = _tidy_history(raw[t], t) if t in have else pd.DataFrame()
+            if hist.empty:
+                try: hist = fetch_history_upto(t, today, days)
+                except Exception: hist = pd.DataFrame()
+            yield t, hist
+        time.sleep(0.5)
+
+def _read_hist_cache(ticker: str) -> pd.DataFrame:
+    p = HIST_CACHE / f"{ticker}.parquet"
+    if not p.exists(): return pd.DataFrame()
+    try: return pd.read_parquet(p)
+    except Exception: return pd.DataFrame()
+
+def _write_hist_cache(ticker: str, hist: pd.DataFrame, days: int) -> pd.DataFrame:
+    cutoff = pd.Timestamp(dt.date.today() - dt.timedelta(days=days))
+    hist = hist[hist["Date"] >= cutoff].reset_index(drop=True)
+    try: hist.to_parquet(HIST_CACHE / f"{ticker}.parquet", index=False)
+    except Exception as e: log(f"WARN 無法寫歷史價快取 {ticker}：{e}")
+    return hist
+
+GAP_BUCKETS = (10, 30, 90)  # 補抓天數的級距（含 5 天重疊）；超過就抓完整 days 天
+
+def fetch_history_batch(tickers: list, days: int = 400, chunk: int = 20):
+    """
+    逐檔 yield (ticker, hist)。先讀 data/hist_cache：
+      - 快取已有今天 → 不連網
+      - 有快取 → 依各檔缺的天數（分級距）補抓 + 5 天重疊；重疊段收盤不一致（除權息後還原價會整段改變）就整段重抓
+      - 沒快取 → 抓完整 days 天
+    """
+    HIST_CACHE.mkdir(parents=True, exist_ok=True)
+    # 已下市/不在清單內的代碼，快取檔一併清掉
+    keep = {f"{t}.parquet" for t in tickers}
+    for p in HIST_CACHE.glob("*.parquet"):
+        if p.name not in keep: p.unlink(missing_ok=True)
+    today = dt.date.today()
+    cached = {t: _read_hist_cache(t) for t in tickers}
+    warm, cold = [], []
+    for t in tickers:
+        c = cached[t]
+        if c.empty: cold.append(t)
+        elif c["Date"].iat[-1].date() >= today: yield t, c
+        else: warm.append(t)
+
+    # 缺的天數每檔各自算，依級距分組下載：停牌股快取停在舊日期，只拖長自己那組，不會讓全部重抓長區間
+    groups = {}
+    for t in warm:
+        gap = (today - cached[t]["Date"].iat[-1].date()).days + 5
+        span = next((b for b in GAP_BUCKETS if gap <= b), days)
+        groups.setdefault(min(span, days), []).append(t)
+    for span, group in sorted(groups.items()):
+        for t, new in _download_batch(group, span, chunk):
+            old = cached[t]
+            if new.empty:
+                yield t, old; continue
+            both = old.merge(new[["Date", "Close"]], on="Date", suffixes=("", "_new"))
+            if both.empty or not np.allclose(both["Close"], both["Close_new"], rtol=1e-6):
+                cold.append(t); continue
+            merged = pd.concat([old, new], ignore_index=True).drop_duplicates("Date", keep="last")
+            yield t, _write_hist_cache(t, merged.sort_values("Date"), days)
+
+    if cold:
+        log(f"INFO 完整下載歷史價：{len(cold)}")
+        for t, hist in _download_batch(cold, days, chunk):
+            yield t, (_write_hist_cache(t, hist, days) if not hist.empty else hist)
+
 def compute_snr(df: pd.DataFrame, window_days: int = 120):
     if df.empty or "Close" not in df.columns: return None
-    roll = df["Close"].rolling(window_days, min_periods=max(20, window_days//4))
+    S, N, R = snr_quantiles(df["Close"].to_numpy(), window_days, max(20, window_days//4))
     out = pd.DataFrame({
         "Date": df["Date"],
         "Close": df["Close"],
-        "S": roll.quantile(0.20),
-        "N": roll.quantile(0.50),
-        "R": roll.quantile(0.80),
+        "S": S,
+        "N": N,
+        "R": R,
     })
     return out
 
+# Parquet 輸出：ZSTD 壓縮 + 字串欄位字典編碼（重複的產業/代碼存成整數索引）
+DICT_COLS = ["Ticker", "shortName", "sector", "industry", "currency", "twse_industry", "Suggestion", "LastDate", "asOfDate"]
+
+# 價格與比率只需 6~7 位有效數字，存 float32；marketCap 數量級到 1e13，維持 float64
+FLOAT32_COLS = ["Close", "S", "N", "R", "DailyReturn", "lastPrice",
+                "trailingPE", "forwardPE", "priceToBook", "returnOnEquity", "grossMargins",
+                "operatingMargins", "revenueGrowth", "earningsGrowth"]
+
+def to_float32(df: pd.DataFrame, cols=FLOAT32_COLS) -> pd.DataFrame:
+    return df.assign(**{c: pd.to_numeric(df[c], errors="coerce").astype("float32") for c in cols if c in df.columns})
+
+def write_parquet(df: pd.DataFrame, path: Path):
+    df = to_float32(df)
+    # marketCap 轉 float64；非數字（如舊快取裡殘留的 {}）一律變 NaN
+    if "marketCap" in df.columns:
+        df = df.assign(marketCap=pd.to_numeric(df["marketCap"], errors="coerce").astype("float64"))
+    df.to_parquet(path, index=False, compression="zstd", compression_level=3, version="2.6",
+                  use_dictionary=[c for c in DICT_COLS if c in df.columns])
+
+def compute_snr_wide(closes: pd.DataFrame, window_days: int = 120):
+    """
+    closes：日期 × 代碼 的收盤寬表（沒交易的日子為 NaN）。一次算完所有代碼的 SNR，
+    回傳 (snr_df 概況表：每檔最後一個交易日, series 長表：每檔每日 Close)。
+    """
+    X = closes.to_numpy(dtype=np.float64)
+    S, N, R = snr_quantiles_2d(X, window_days, max(20, window_days//4))
+    valid = ~np.isnan(X)
+    n, cols = X.shape[0], np.arange(X.shape[1])
+    last = n - 1 - np.argmax(valid[::-1], axis=0)          # 每檔最後一個有效列
+    valid[last, cols] = False
+    prev_i = n - 1 - np.argmax(valid[::-1], axis=0)        # 倒數第二個有效列
+    prev = np.where(valid.any(axis=0), X[prev_i, cols], np.nan)
+    valid[last, cols] = True
+    close = X[last, cols]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret = np.where(prev != 0, close / prev - 1, np.nan)
+    snr_df = pd.DataFrame({
+        "Ticker": closes.columns.astype(str),
+        "LastDate": closes.index[last].strftime("%Y-%m-%d"),
+        "Close": close,
+        "S": S[last, cols],
+        "N": N[last, cols],
+        "R": R[last, cols],
+        "DailyReturn": ret,
+    })
+    r, c = np.nonzero(valid)
+    series = pd.DataFrame({
+        "Ticker": closes.columns.astype(str)[c], "Date": closes.index[r],
+        "Close": X[r, c],
+    })
+    return snr_df, series
+
+def save_snr_series(series: pd.DataFrame) -> Path:
+    """
+    每檔每日收盤存成單一檔（依 Ticker、日期排序），App 依所選視窗用 snr_quantiles 自己算 S/N/R。
+    這個檔每天整個重寫並 commit：只存 Close、不切每檔一個 row group（上千個 row group 的 footer 比資料還大）。
+    """
+    out_path = DATA_DIR / "snr_series.parquet"
+    df = series.rename(columns={"Date": "日期"})
+    df = to_float32(df[["Ticker", "日期", "Close"]], ["Close"])
+    df = df.sort_values(["Ticker", "日期"], kind="stable").reset_index(drop=True)
+    tmp = out_path.with_name(out_path.name + ".tmp")
+    # 日期只有幾百種 → 字典編碼；收盤用 byte_stream_split 讓 zstd 壓得更小
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp, compression="zstd",
+                   use_dictionary=["Ticker", "日期"], use_byte_stream_split=["Close"])
+    shutil.rmtree(out_path, ignore_errors=True)  # 舊版是依 Ticker 分割的目錄
+    os.replace(tmp, out_path)
+    return out_path
+
+MANIFEST = DATA_DIR / "manifest.json"
+
+def write_manifest(file_date: str, **paths):
+    """App 讀這個檔就知道資料日期與檔案位置，不必 glob 整個 data/。"""
+    MANIFEST.write_text(json.dumps({"date": file_date, **{k: str(v) for k, v in paths.items()}},
+                                   ensure_ascii=False), encoding="utf-8")
+
 # ---------- fallback ----------
 def use_previous_as_fallback():
+    # 平常不再輸出 CSV 快照，既有的 parquet + manifest 就是上一版；
+    # 只有 parquet 不存在，或 CSV 快照比 manifest 的日期還新時，才用 CSV 覆蓋
+    have_parquet = (DATA_DIR / "fundamentals.parquet").exists() and (DATA_DIR / "snr_summary.parquet").exists()
+    try: man_date = json.loads(MANIFEST.read_text(encoding="utf-8")).get("date", "")
+    except Exception: man_date = ""
     prev_f = sorted(glob.glob("data/fundamentals_*.csv"))
     prev_s = sorted(glob.glob("data/snr_summary_*.csv"))
-    if not prev_f or not prev_s:
-        log("FATAL 沒有可用的舊檔可沿用。")
+    file_date = os.path.basename(prev_s[-1]).split("_")[-1].replace(".csv","") if prev_s else ""
+    newer = bool(prev_f and file_date and man_date and file_date > man_date)
+    if not prev_f or not prev_s or (have_parquet and not newer):
+        if have_parquet:
+            log(f"OK 沿用現有 parquet 與 manifest（{man_date or '日期未知'}）。")
+        else:
+            log("FATAL 沒有可用的舊檔可沿用。")
         return
-    fund_csv = prev_f[-1]; snr_csv = prev_s[-1]
-    fund_df = pd.read_csv(fund_csv); snr_df = pd.read_csv(snr_csv)
-    file_date = os.path.basename(snr_csv).split("_")[-1].replace(".csv","")
+    fund_df = pd.read_csv(prev_f[-1]); snr_df = pd.read_csv(prev_s[-1])
     fund_df["asOfDate"] = file_date
     snr_df["asOfDate"] = file_date
     try:
-        fund_df.to_parquet(DATA_DIR / "fundamentals.parquet", index=False)
-        snr_df.to_parquet(DATA_DIR / "snr_summary.parquet", index=False)
+        write_parquet(fund_df, DATA_DIR / "fundamentals.parquet")
+        write_parquet(snr_df, DATA_DIR / "snr_summary.parquet")
+        write_manifest(file_date, fund=DATA_DIR / "fundamentals.parquet", snr=DATA_DIR / "snr_summary.parquet")
     except Exception as e:
         log(f"WARN 無法寫 parquet：{e}")
     log(f"OK 使用上一版覆蓋 parquet：{file_date}（fund={len(fund_df)}、snr={len(snr_df)}）")
@@ -148,4 +458,43 @@ def main():
         return use_previous_as_fallback()
     tickers = tickers_df["yahoo"].tolist()
 
-    # 基本面
+    # 基本面（yahooquery quoteSummary）與歷史價（yf.download chart）走不同端點、互不相依：
+    # 基本面丟到背景執行緒，主執行緒同時抓歷史價，兩段的網路等待重疊
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        fund_job = ex.submit(pull_fundamentals_batch, tickers)
+        # 歷史價 + SNR：所有代碼收盤組成一張寬表，一次算完
+        closes = {t: h.drop_duplicates("Date", keep="last").set_index("Date")["Close"]
+                  for t, h in fetch_history_batch(tickers, 400) if not h.empty}
+        fund_df = fund_job.result()
+    log(f"INFO 基本面完成：{len(fund_df)}")
+    if not closes:
+        log("ERROR 抓不到任何歷史價；改用上一版資料做備援。")
+        return use_previous_as_fallback()
+    wide = pd.concat(closes, axis=1, sort=True)
+    snr_df, series = compute_snr_wide(wide, 120)
+    snr_df["Suggestion"] = suggest_array(snr_df["Close"], snr_df["S"], snr_df["R"])
+
+    # 資料日期＝最近交易日（假日沿用上一交易日）：寬表已依日期排序，最後一列就是，不必再掃 LastDate
+    file_date = wide.index[-1].strftime("%Y-%m-%d")
+    fund_df["asOfDate"] = file_date
+    snr_df["asOfDate"] = file_date
+
+    # 產業對照 + 產業相對表現（失敗不影響主資料）
+    try:
+        fund_df = attach_industry_to_fundamentals(fund_df, update_industry_map())
+        save_sector_performance(compute_sector_performance(fund_df, snr_df), file_date)
+    except Exception as e:
+        log(f"WARN 產業表現計算失敗：{e}")
+
+    # CSV 快照與 parquet 內容重複，只在設定 EMIT_CSV 時輸出
+    if os.environ.get("EMIT_CSV"):
+        write_csv(fund_df, DATA_DIR / f"fundamentals_{file_date}.csv")
+        write_csv(snr_df, DATA_DIR / f"snr_summary_{file_date}.csv")
+    write_parquet(fund_df, DATA_DIR / "fundamentals.parquet")
+    write_parquet(snr_df, DATA_DIR / "snr_summary.parquet")
+    write_manifest(file_date, fund=DATA_DIR / "fundamentals.parquet", snr=DATA_DIR / "snr_summary.parquet",
+                   snr_series=save_snr_series(series))
+    log(f"OK 資料日期 {file_date}（fund={len(fund_df)}、snr={len(snr_df)}）")
+
+if __name__ == "__main__":
+    main()
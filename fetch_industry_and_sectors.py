@@ -4,9 +4,13 @@
 # (B) 根據全市場個股的「市值加權單日報酬」計算各產業相對於大盤（優/相/劣）
 
 from __future__ import annotations
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import requests, time, os, re, glob
+import lxml.html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Optional, Tuple
 
 DATA_DIR = Path("data")
@@ -17,6 +21,13 @@ HEADERS = {
     "Accept-Language": "zh-TW,zh;q=0.9,en;q=0.8",
 }
 
+# MOPS / TWSE 共用一個 keep-alive session：同主機的後續請求不必再做 TCP + TLS 握手；
+# 連線層錯誤由 adapter 自動退避重試（data_updater 也用這個 session）
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                      max_retries=Retry(total=3, backoff_factor=1)))
+
 # -----------------------------
 # A) 產業對照：抓 MOPS 上市/上櫃公司彙總表
 # -----------------------------
@@ -24,24 +35,78 @@ def _mops_try_fetch(url: str, method: str = "GET", data: Optional[dict] = None,
     for i in range(retries):
         try:
             if method == "POST":
-                r = requests.post(url, headers=HEADERS, data=data, timeout=30)
+                r = SESSION.post(url, data=data, timeout=30)
             else:
-                r = requests.get(url, headers=HEADERS, timeout=30)
+                r = SESSION.get(url, timeout=30)
             if r.status_code == 200 and r.text:
                 return r.text
         except Exception:
             time.sleep(sleep * (i + 1))
     return None
 
+def _span(cell, attr: str) -> int:
+    v = str(cell.get(attr, "1")).strip()
+    return max(int(v), 1) if v.isdigit() else 1
+
+def _table_grid(table) -> tuple[list[list[str]], int]:
+    # 依 colspan/rowspan 展開成方格；回傳 (各列文字, 開頭 thead 或純 th 的表頭列數)
+    grid, pending, n_head = [], {}, 0   # pending: 欄位 -> [文字, 尚需往下填的列數]
+    for tr in table.xpath("./tr|./thead/tr|./tbody/tr"):
+        cells = tr.xpath("./th|./td")
+        if not cells:
+            continue
+        row, queue = [], list(cells)
+        while queue or len(row) in pending:
+            col = len(row)
+            if col in pending:  # 上方 rowspan 延續下來的格
+                text, left = pending[col]
+                row.append(text)
+                if left > 1: pending[col] = [text, left - 1]
+                else: del pending[col]
+                continue
+            c = queue.pop(0)
+            text, down = c.text_content().strip(), _span(c, "rowspan")
+            for _ in range(_span(c, "colspan")):
+                if down > 1: pending[len(row)] = [text, down - 1]
+                row.append(text)
+        if n_head == len(grid) and (tr.getparent().tag == "thead" or all(c.tag == "th" for c in cells)):
+            n_head += 1
+        grid.append(row)
+    return grid, max(n_head, 1)
+
 def _parse_tables(html: str) -> list[pd.DataFrame]:
-    # 先用 lxml，再用 bs4/html5lib
+    # lxml 解析一次，逐張 <table> 展開 colspan/rowspan；開頭的多列表頭逐欄合併成欄名，欄數對得上的列當資料
     try:
-        return pd.read_html(html)
+        tree = lxml.html.fromstring(html)
     except Exception:
-        try:
-            return pd.read_html(html, flavor="bs4")
-        except Exception:
-            return []
+        return []
+    out = []
+    for table in tree.xpath("//table"):
+        grid, n_head = _table_grid(table)
+        if len(grid) <= n_head:
+            continue
+        width = len(grid[n_head - 1])
+        head = [r for r in grid[:n_head] if len(r) == width]
+        columns = [" ".join(dict.fromkeys(p for p in parts if p)) for parts in zip(*head)]
+        body = [r for r in grid[n_head:] if len(r) == width]
+        if body:
+            out.append(pd.DataFrame(body, columns=columns))
+    return out
+
+def _read_html_tables(html: str) -> list[pd.DataFrame]:
+    # 備援：自家解析一張對照表都沒拿到時，改用 pandas.read_html（多層表頭攤平成單層）
+    from io import StringIO
+    try:
+        tables = pd.read_html(StringIO(html))
+    except Exception:
+        return []
+    for t in tables:
+        if isinstance(t.columns, pd.MultiIndex):
+            t.columns = [" ".join(dict.fromkeys(str(p) for p in c if not str(p).startswith("Unnamed")))
+                         for c in t.columns]
+    return tables
+
+CODE4_RE = re.compile(r"(\d{4})")  # 公司代號欄可能夾雜名稱/空白，取第一組 4 碼
 
 def _normalize_industry_map(df: pd.DataFrame) -> pd.DataFrame:
     # 期待含「公司代號」「產業類別」欄位；不同版型容錯處理
@@ -54,7 +119,7 @@ def _normalize_industry_map(df: pd.DataFrame) -> pd.DataFrame:
 
     out = df[[code_col, ind_col]].copy()
     out.columns = ["code", "twse_industry"]
-    out["code"] = out["code"].astype(str).str.extract(r"(\d{4})")[0]
+    out["code"] = out["code"].astype(str).str.extract(CODE4_RE, expand=False)
     out = out.dropna(subset=["code"]).drop_duplicates(subset=["code"])
     out["twse_industry"] = out["twse_industry"].astype(str).str.strip()
     out.loc[out["twse_industry"].eq("") | out["twse_industry"].isna(), "twse_industry"] = "未分類"
@@ -75,16 +140,27 @@ def update_industry_map() -> Path:
         ("https://mops.twse.com.tw/mops/web/index", "GET", None),
     ]
 
+    def _maps(tables):
+        found = []
+        for t in tables:
+            # 多數是版面/導覽用的表：欄名缺「代號」或「產業」任一個就不必進 normalize（與 normalize 的條件相同）
+            names = " ".join(str(c) for c in t.columns)
+            if "代號" not in names or "產業" not in names:
+                continue
+            norm = _normalize_industry_map(t)
+            if not norm.empty:
+                found.append(norm)
+        return found
+
     frames = []
     for url, method, data in endpoints:
         html = _mops_try_fetch(url, method, data)
         if not html:
             continue
-        tables = _parse_tables(html)
-        for t in tables:
-            norm = _normalize_industry_map(t)
-            if not norm.empty:
-                frames.append(norm)
+        found = _maps(_parse_tables(html))
+        if not found:
+            found = _maps(_read_html_tables(html))
+        frames.extend(found)
 
     if frames:
         merged = pd.concat(frames, ignore_index=True).drop_duplicates(subset=["code"])
@@ -103,28 +179,18 @@ def attach_industry_to_fundamentals(fund_df: pd.DataFrame, industry_csv: Path) -
     """
     if not industry_csv.exists():
         # 沒有 map 時，全部未分類
-        fund_df = fund_df.copy()
-        fund_df["twse_industry"] = "未分類"
-        return fund_df
+        return fund_df.assign(twse_industry=pd.Categorical(["未分類"] * len(fund_df)))
 
     map_df = pd.read_csv(industry_csv, dtype={"code": str})
-    fund_df = fund_df.copy()
-    fund_df["code"] = fund_df["Ticker"].astype(str).str.extract(r"(\d{4})")[0]
-    merged = fund_df.merge(map_df, on="code", how="left")
-    merged["twse_industry"] = merged["twse_industry"].fillna("未分類")
-    merged = merged.drop(columns=["code"])
-    return merged
+    # Ticker 一律是 4 碼代號 + .TW/.TWO：直接切前 4 碼，用 dict 查表（code 在 map 內不重複）
+    lookup = dict(zip(map_df["code"], map_df["twse_industry"]))
+    code = fund_df["Ticker"].astype(str).str.slice(0, 4)
+    # 產業只有約 30 種：存成 category，groupby 走整數代碼、parquet 直接字典編碼
+    return fund_df.assign(twse_industry=code.map(lookup).fillna("未分類").astype("category"))
 
 # -----------------------------
 # B) 產業相對表現
 # -----------------------------
-def _weighted_daily_return(frame: pd.DataFrame, ret_col: str, mcap_col: str) -> float:
-    df = frame[[ret_col, mcap_col]].dropna()
-    if df.empty: return float("nan")
-    w = df[mcap_col].clip(lower=0)
-    if w.sum() == 0: return float("nan")
-    return (df[ret_col] * w).sum() / w.sum()
-
 def compute_sector_performance(fund_df_with_ind: pd.DataFrame, snr_df: pd.DataFrame,
                                ret_col: str = "DailyReturn", mcap_col: str = "marketCap",
                                threshold: float = 0.003) -> pd.DataFrame:
@@ -134,44 +200,42 @@ def compute_sector_performance(fund_df_with_ind: pd.DataFrame, snr_df: pd.DataFr
       diff <= -0.3% → 劣於大盤
       其餘 → 相似
     """
+    cols = ["twse_industry", "n", "industry_ret", "market_ret", "diff", "relation"]
     if fund_df_with_ind is None or fund_df_with_ind.empty or snr_df is None or snr_df.empty:
-        return pd.DataFrame(columns=["twse_industry", "n", "industry_ret", "market_ret", "diff", "relation"])
+        return pd.DataFrame(columns=cols)
 
     # 準備合併：snr_df 需要 DailyReturn（你在 updater 會補上）
     snr_use = snr_df[["Ticker", ret_col]].dropna()
-    base = fund_df_with_ind.merge(snr_use, on="Ticker", how="inner")
-
-    # 大盤（全市場加權）報酬
-    market_ret = _weighted_daily_return(base, ret_col=ret_col, mcap_col=mcap_col)
-
-    # 產業分組
-    grp = base.groupby("twse_industry", dropna=False)
-    rows = []
-    for ind, g in grp:
-        ind_ret = _weighted_daily_return(g, ret_col=ret_col, mcap_col=mcap_col)
-        diff = ind_ret - market_ret if pd.notna(ind_ret) and pd.notna(market_ret) else float("nan")
-        if pd.isna(diff):
-            relation = "相似"
-        elif diff >= threshold:
-            relation = "優於大盤"
-        elif diff <= -threshold:
-            relation = "劣於大盤"
-        else:
-            relation = "相似"
-        rows.append({
-            "twse_industry": ind or "未分類",
-            "n": len(g),
-            "industry_ret": ind_ret,
-            "market_ret": market_ret,
-            "diff": diff,
-            "relation": relation
-        })
-    out = pd.DataFrame(rows).sort_values(["relation", "diff"], ascending=[True, False])
-    return out
+    base = fund_df_with_ind[["Ticker", "twse_industry", mcap_col]].merge(snr_use, on="Ticker", how="inner")
+    if base.empty:
+        return pd.DataFrame(columns=cols)
+
+    # 權重＝市值（負值視為 0）；報酬或市值缺值的列權重為 0，不計入加權但仍算在 n 內
+    ok = base[ret_col].notna() & base[mcap_col].notna()
+    w = base[mcap_col].clip(lower=0).where(ok, 0.0)
+    parts = pd.DataFrame({"twse_industry": base["twse_industry"], "w": w,
+                          "wr": (base[ret_col] * w).where(ok, 0.0)})
+
+    # 大盤（全市場加權）報酬；產業分組一次 groupby-sum 算分子/分母
+    market_ret = parts["wr"].sum() / parts["w"].sum() if parts["w"].sum() > 0 else np.nan
+    agg = parts.groupby("twse_industry", dropna=False, observed=True).agg(
+        n=("w", "size"), wr=("wr", "sum"), w=("w", "sum"))
+    ind_ret = agg["wr"] / agg["w"].where(agg["w"] > 0)
+    diff = ind_ret - market_ret
+    out = pd.DataFrame({
+        "twse_industry": agg.index.astype(object).fillna("未分類"),
+        "n": agg["n"].to_numpy(),
+        "industry_ret": ind_ret.to_numpy(),
+        "market_ret": market_ret,
+        "diff": diff.to_numpy(),
+        # diff 為 NaN 時兩個比較都是 False → 相似
+        "relation": np.select([diff >= threshold, diff <= -threshold], ["優於大盤", "劣於大盤"], default="相似"),
+    })
+    return out.sort_values(["relation", "diff"], ascending=[True, False])
 
 def save_sector_performance(perf_df: pd.DataFrame, as_of_date: str) -> Path:
     out_path = DATA_DIR / "sectors_daily.parquet"
     perf = perf_df.copy()
     perf["asOfDate"] = as_of_date
-    perf.to_parquet(out_path, index=False)
+    perf.to_parquet(out_path, index=False, compression="zstd")
     return out_path
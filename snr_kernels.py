@@ -0,0 +1,100 @@
+# snr_kernels.py
+# SNR 用的滾動分位數核心（numba 編譯）。
+# 同一個視窗維持一份排序緩衝區：每步二分搜尋移除舊值、插入新值，
+# 再一次讀出 20% / 50% / 80% 三個分位數（線性內插，與 pandas rolling.quantile 相同）。
+# 另有向量化的建議文字（suggest_array），ETL 與 App 共用。
+
+import numpy as np
+from numba import njit, prange
+
+SNR_QS = (0.20, 0.50, 0.80)
+
+# nogil：App 端每個使用者一條執行緒，算 SNR 時不卡住其他 session
+@njit(cache=True, nogil=True)
+def _rolling_quantiles(x, window, min_periods, qs):
+    n = x.shape[0]
+    m = qs.shape[0]
+    out = np.full((m, n), np.nan)
+    buf = np.empty(window)
+    k = 0
+    for i in range(n):
+        # 移出視窗最舊的值
+        if i >= window:
+            old = x[i - window]
+            if not np.isnan(old):
+                j = np.searchsorted(buf[:k], old)
+                for p in range(j, k - 1):
+                    buf[p] = buf[p + 1]
+                k -= 1
+        # 插入新值
+        v = x[i]
+        if not np.isnan(v):
+            j = np.searchsorted(buf[:k], v)
+            for p in range(k, j, -1):
+                buf[p] = buf[p - 1]
+            buf[j] = v
+            k += 1
+        if k == 0 or k < min_periods:
+            continue
+        for a in range(m):
+            pos = qs[a] * (k - 1)
+            lo = int(np.floor(pos))
+            hi = min(lo + 1, k - 1)
+            out[a, i] = buf[lo] + (buf[hi] - buf[lo]) * (pos - lo)
+    return out
+
+def snr_quantiles(close, window: int, min_periods: int):
+    """回傳 (支撐, 中位, 壓力) 三條 numpy 陣列；NaN 不計入 min_periods。"""
+    x = np.ascontiguousarray(close, dtype=np.float64)
+    q = _rolling_quantiles(x, int(window), int(min_periods), np.array(SNR_QS))
+    return q[0], q[1], q[2]
+
+@njit(cache=True, parallel=True, nogil=True)
+def _rolling_quantiles_2d(X, window, min_periods, qs):
+    # 逐欄（代碼）處理；先壓掉該檔的 NaN（停牌/未上市的日子），視窗只算自己的交易日
+    # 各欄互不相干、各自有排序緩衝區，用 prange 分到多核心
+    n, k = X.shape
+    m = qs.shape[0]
+    out = np.full((m, n, k), np.nan)
+    for j in prange(k):
+        col = X[:, j]
+        pos = np.nonzero(~np.isnan(col))[0]
+        if pos.shape[0] == 0:
+            continue
+        q = _rolling_quantiles(col[pos], window, min_periods, qs)
+        for a in range(m):
+            for i in range(pos.shape[0]):
+                out[a, pos[i], j] = q[a, i]
+    return out
+
+def snr_quantiles_2d(closes, window: int, min_periods: int):
+    """closes 為 日期 × 代碼 的收盤矩陣；回傳同形狀的 (支撐, 中位, 壓力)。"""
+    X = np.asarray(closes, dtype=np.float64)
+    q = _rolling_quantiles_2d(X, int(window), int(min_periods), np.array(SNR_QS))
+    return q[0], q[1], q[2]
+
+def last_snr(close, window: int, min_periods: int):
+    """只需要最後一天時用：對最後 window 筆做一次 nanquantile，結果與完整序列的最後一列相同。"""
+    x = np.asarray(close, dtype=np.float64)[-int(window):]
+    if np.count_nonzero(~np.isnan(x)) < max(int(min_periods), 1):
+        return np.nan, np.nan, np.nan
+    S, N, R = np.nanquantile(x, SNR_QS)
+    return S, N, R
+
+SUGGESTIONS = np.array([
+    "接近支撐：偏多、可分批佈局",
+    "接近壓力：保守、等待回檔",
+    "區間下半：偏多但勿追高",
+    "區間上半：觀望或逢高減碼",
+    "資料不足",
+])
+
+def suggest_array(close, S, R, near: float = 0.03) -> np.ndarray:
+    """整批 (現價, 支撐, 壓力) 一次判斷；任一為 NaN 回傳「資料不足」。"""
+    close, S, R = (np.asarray(a, dtype=np.float64) for a in (close, S, R))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dS = np.where(S != 0, (close - S) / S, np.inf)
+        dR = np.where(R != 0, (R - close) / R, np.inf)
+    idx = np.where(dS <= near, 0, np.where(dR <= near, 1, np.where(close < (S + R) / 2, 2, 3)))
+    idx[np.isnan(close) | np.isnan(S) | np.isnan(R)] = 4
+    return SUGGESTIONS[idx]